@@ -15,91 +15,79 @@
 # You should have received a copy of the GNU General Public License
 # along with crun.  If not, see <http://www.gnu.org/licenses/>.
 
+import functools
 import time
-import json
 import subprocess
 import os
-import shutil
 import sys
-import tempfile
 from tests_utils import *
 
+_PROCESS_SPEC = {
+    "user": {
+        "uid": 0,
+        "gid": 0,
+        "additionalGids": [432]
+    },
+    "terminal": False,
+    "args": [
+        "/init",
+        "groups"
+    ],
+    "env": [
+        "PATH=/bin",
+        "TERM=xterm"
+    ],
+    "cwd": "/",
+    "noNewPrivileges": True
+}
+
+_PROCESS_SPEC_BYTES = json_dumps(_PROCESS_SPEC)
+
+# the paused container shared by all the tests, created by setup_shared_container
+shared_cid = None
+
+def setup_shared_container():
+    global shared_cid
+    conf = fresh_conf(args=['/init', 'pause'])
+    _, shared_cid = run_and_get_output(conf, command='run', detach=True)
+    return lambda: run_crun_command(["delete", "-f", shared_cid])
+
 def test_exec():
-    conf = base_config()
-    conf['process']['args'] = ['/init', 'pause']
-    add_all_namespaces(conf)
-    cid = None
-    try:
-        _, cid = run_and_get_output(conf, command='run', detach=True)
-        out = run_crun_command(["exec", cid, "/init", "echo", "foo"])
-        if "foo" not in out:
-            return -1
-    finally:
-        if cid is not None:
-            run_crun_command(["delete", "-f", cid])
+    cid = shared_cid
+    out = run_crun_command(["exec", cid, "/init", "echo", "foo"])
+    if "foo" not in out:
+        return -1
     return 0
 
+@functools.lru_cache(maxsize=None)
 def test_exec_not_exists_helper(detach):
-    conf = base_config()
-    conf['process']['args'] = ['/init', 'pause']
-    add_all_namespaces(conf)
-    cid = None
+    cid = shared_cid
     try:
-        _, cid = run_and_get_output(conf, command='run', detach=True)
-        try:
-            if detach:
-                out = run_crun_command(["exec", "-d", cid, "/not.here"])
-            else:
-                out = run_crun_command(["exec", cid, "/not.here"])
-        except Exception as e:
-            return 0
-    finally:
-        if cid is not None:
-            run_crun_command(["delete", "-f", cid])
+        if detach:
+            out = run_crun_command(["exec", "-d", cid, "/not.here"])
+        else:
+            out = run_crun_command(["exec", cid, "/not.here"])
+    except Exception as e:
+        return 0
     return 1
 
 def test_exec_not_exists():
     return test_exec_not_exists_helper(False)
 
 def test_exec_detach_not_exists():
-    return test_exec_not_exists_helper(False)
+    return test_exec_not_exists_helper(True)
 
 def test_exec_additional_gids():
-    conf = base_config()
-    conf['process']['args'] = ['/init', 'pause']
-    add_all_namespaces(conf)
-    cid = None
-    tempdir = tempfile.mkdtemp()
+    cid = shared_cid
+    fd = os.memfd_create("process.json", os.MFD_CLOEXEC)
     try:
-        _, cid = run_and_get_output(conf, command='run', detach=True)
-
-        process_file = os.path.join(tempdir, "process.json")
-        with open(process_file, "w") as f:
-            json.dump({
-	        "user": {
-	            "uid": 0,
-	            "gid": 0,
-                    "additionalGids": [432]
-	        },
-                "terminal": False,
-	        "args": [
-                    "/init",
-                    "groups"
-	        ],
-	        "env": [
-	            "PATH=/bin",
-	            "TERM=xterm"
-	        ],
-	        "cwd": "/",
-	        "noNewPrivileges": True
-            }, f)
+        os.write(fd, _PROCESS_SPEC_BYTES)
+        process_file = "/proc/%d/fd/%d" % (os.getpid(), fd)
         out = run_crun_command(["exec", "--process", process_file, cid])
         if "432" not in out:
             return -1
     finally:
-        if cid is not None:
-            run_crun_command(["delete", "-f", cid])
-        shutil.rmtree(tempdir)
+        os.close(fd)
     return 0
 
 all_tests = {
@@ -110,4 +98,4 @@ all_tests = {
 }
 
 if __name__ == "__main__":
-    tests_main(all_tests)
+    tests_main(all_tests, setup=setup_shared_container)
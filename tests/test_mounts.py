@@ -22,7 +22,6 @@ import os
 import shutil
 import sys
 from tests_utils import *
-import tempfile
 
 try:
     import libmount
@@ -30,41 +29,84 @@ except Exception:
     print("1..0")
     sys.exit(0)
 
-def helper_mount(options, tmpfs=True):
-    conf = base_config()
-    conf['process']['args'] = ['/init', 'cat', '/proc/self/mountinfo']
-    add_all_namespaces(conf)
+mount_options = ["ro", "rw", "relatime", "strictatime", "exec", "noexec",
+                 "suid", "nosuid", "sync", "dirsync", "nodev", "dev"]
+
+def mount_destination(options, tmpfs):
+    return "/var/dir_%s_%s" % ("tmpfs" if tmpfs else "bind", options)
+
+def split_options(options):
+    if not options:
+        return frozenset()
+    return frozenset(options.split(","))
+
+def mount_config(options, tmpfs):
+    destination = mount_destination(options, tmpfs)
     if tmpfs:
-        mount_opt = {"destination": "/var/dir", "type": "tmpfs", "source": "tmpfs", "options": [options]}
-    else:
-        mount_opt = {"destination": "/var/dir", "type": "bind", "source": get_tests_root(), "options": ["bind", "rprivate"] + [options]}
-    conf['mounts'].append(mount_opt)
-    out, _ = run_and_get_output(conf, hide_stderr=True)
-    with tempfile.NamedTemporaryFile(mode='w', delete=True) as f:
-        f.write(out)
-        f.flush()
-        t = libmount.Table(f.name)
-        m = t.find_target('/var/dir')
-        return [m.vfs_options, m.fs_options]
-    return -1
+        return {"destination": destination, "type": "tmpfs", "source": "tmpfs", "options": [options]}
+    return {"destination": destination, "type": "bind", "source": get_tests_root(), "options": ["bind", "rprivate"] + [options]}
+
+# run a container with the given mounts and parse its mountinfo,
+# as {target: (vfs_options, fs_options)}
+def parse_mountinfo(mounts):
+    conf = fresh_conf(args=['/init', 'cat', '/proc/self/mountinfo'], extra_mounts=mounts)
+    proc, _ = run_and_get_output(conf, hide_stderr=True, use_popen=True)
+    out = read_process_output(proc, CRUN_COMMAND_TIMEOUT)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args, output=out)
+    # the libmount bindings only parse paths, so avoid a file on disk
+    fd = os.memfd_create("mountinfo", os.MFD_CLOEXEC)
+    try:
+        os.write(fd, out)
+        t = libmount.Table("/proc/self/fd/%d" % fd)
+    finally:
+        os.close(fd)
+    parsed = {}
+    while True:
+        fs = t.next_fs()
+        if fs is None:
+            break
+        parsed[fs.target] = (split_options(fs.vfs_options), split_options(fs.fs_options))
+    return parsed
+
+# the mountinfo of a single container with all the option mounts, or the
+# error that prevented creating it
+shared_mountinfo = None
+shared_mountinfo_error = None
+
+def setup_shared_mountinfo():
+    global shared_mountinfo, shared_mountinfo_error
+    mounts = [mount_config(options, tmpfs) for tmpfs in [True, False] for options in mount_options]
+    try:
+        shared_mountinfo = parse_mountinfo(mounts)
+    except Exception as e:
+        # a single rejected mount must not fail every test, so each
+        # test falls back to a container with only its own mount
+        shared_mountinfo_error = e
+
+def helper_mount(options, tmpfs=True):
+    destination = mount_destination(options, tmpfs)
+    if shared_mountinfo is not None:
+        return shared_mountinfo[destination]
+    try:
+        return parse_mountinfo([mount_config(options, tmpfs)])[destination]
+    except Exception:
+        if shared_mountinfo_error is not None:
+            sys.stderr.write("the shared mountinfo setup failed too:\n")
+            report_exception(shared_mountinfo_error)
+        raise
 
 def test_mount_symlink():
-    conf = base_config()
-    conf['process']['args'] = ['/init', 'cat', '/proc/self/mountinfo']
-    add_all_namespaces(conf)
     mount_opt = {"destination": "/etc/localtime", "type": "bind", "source": "/etc/localtime", "options": ["bind", "ro"]}
-    conf['mounts'].append(mount_opt)
+    conf = fresh_conf(args=['/init', 'cat', '/proc/self/mountinfo'], extra_mounts=[mount_opt])
     out, _ = run_and_get_output(conf, hide_stderr=True)
     if "Rome" in out:
         return 0
     return -1
 
 def test_mount_symlink_not_existing():
-    conf = base_config()
-    conf['process']['args'] = ['/init', 'cat', '/proc/self/mountinfo']
-    add_all_namespaces(conf)
     mount_opt = {"destination": "/etc/not-existing", "type": "bind", "source": "/etc/localtime", "options": ["bind", "ro"]}
-    conf['mounts'].append(mount_opt)
+    conf = fresh_conf(args=['/init', 'cat', '/proc/self/mountinfo'], extra_mounts=[mount_opt])
     out, _ = run_and_get_output(conf, hide_stderr=True)
     if "foo/bar" in out:
         return 0
@@ -190,4 +232,6 @@ all_tests = {
 }
 
 if __name__ == "__main__":
-    tests_main(all_tests)
+    # the symlink tests run their own container
+    option_tests = [k for k in all_tests if "symlink" not in k]
+    tests_main(all_tests, setup=setup_shared_mountinfo, setup_tests=option_tests)
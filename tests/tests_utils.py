@@ -15,14 +15,25 @@
 # You should have received a copy of the GNU General Public License
 # along with crun.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
+import functools
 import json
+import multiprocessing
 import shutil
 import sys
 import os
+import selectors
 import tempfile
 import subprocess
 import time
 
+try:
+    import orjson
+    json_dumps = orjson.dumps
+except ImportError:
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
+
 base_conf = """
 {
     "ociVersion": "1.0.0",
@@ -135,6 +146,13 @@ base_conf = """
 def base_config():
     return json.loads(base_conf)
 
+def patch_config(conf, args=None, extra_mounts=None):
+    if args is not None:
+        conf['process']['args'] = args
+    if extra_mounts is not None:
+        conf['mounts'].extend(extra_mounts)
+    return conf
+
 def parse_proc_status(content):
     r = {}
     for i in content.split("\n"):
@@ -157,32 +175,108 @@ def add_all_namespaces(conf, cgroupns=False, userns=False):
         if i not in has:
             conf['linux']['namespaces'].append({"type" : i})
 
-def run_all_tests(all_tests, allowed_tests):
+@functools.lru_cache(maxsize=4)
+def _base_with_all_ns_frozen(cgroupns=False, userns=False):
+    c = base_config()
+    add_all_namespaces(c, cgroupns=cgroupns, userns=userns)
+    return json_dumps(c)
+
+def fresh_conf(args=None, extra_mounts=None, cgroupns=False, userns=False):
+    conf = json.loads(_base_with_all_ns_frozen(cgroupns, userns))
+    return patch_config(conf, args, extra_mounts)
+
+# the tests run serially unless CRUN_TEST_JOBS asks for more workers
+def get_test_jobs():
+    jobs = os.getenv("CRUN_TEST_JOBS")
+    if jobs is None:
+        return 1
+    try:
+        return max(int(jobs), 1)
+    except ValueError:
+        sys.stderr.write("invalid CRUN_TEST_JOBS=%s, running the tests serially\n" % jobs)
+        return 1
+
+def report_exception(e):
+    if hasattr(e, 'output'):
+        sys.stderr.write(str(e.output) + "\n")
+    sys.stderr.write(str(e) + "\n")
+    sys.stderr.flush()
+
+def run_test(test):
+    _, v = test
+    try:
+        return v()
+    except Exception as e:
+        report_exception(e)
+        return -1
+
+def run_all_tests(all_tests, allowed_tests, setup=None, setup_tests=None):
     tests = all_tests
     if allowed_tests is not None:
         allowed_tests = allowed_tests.split()
         tests = {k: v for k, v in tests.items() if k in allowed_tests}
 
     print("1..%d" % len(tests))
-    cur = 0
-    for k, v in tests.items():
-        cur = cur + 1
-        ret = -1
+    # flush before forking the workers, so the plan is not printed twice
+    sys.stdout.flush()
+
+    # the setup runs only if a selected test needs it, and before the
+    # workers are forked so that they share its state
+    needs_setup = [k for k in tests if setup_tests is None or k in setup_tests]
+    teardown = None
+    teardown_ok = True
+    setup_error = None
+    if setup is not None and len(needs_setup) > 0:
         try:
-            ret = v()
-            if ret == 0:
-                print("ok %d - %s" % (cur, k))
-            elif ret == 77:
-                print("ok %d - %s #SKIP" % (cur, k))
-            else:
-                print("not ok %d - %s" % (cur, k))
+            teardown = setup()
         except Exception as e:
-            if hasattr(e, 'output'):
-                sys.stderr.write(str(e.output) + "\n")
-            sys.stderr.write(str(e) + "\n")
+            setup_error = e
+            sys.stderr.write("setup failed\n")
+            report_exception(e)
+
+    try:
+        # if the setup failed, the tests that need it are not run at all
+        skipped = needs_setup if setup_error is not None else []
+        runnable = {k: v for k, v in tests.items() if k not in skipped}
+        jobs = min(get_test_jobs(), len(runnable))
+        if jobs <= 1:
+            run_results(tests, map(run_test, runnable.items()), skipped, setup_error)
+        else:
+            # the tests are dispatched by reference, so the workers must be forked
+            ctx = multiprocessing.get_context("fork")
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=ctx) as executor:
+                run_results(tests, executor.map(run_test, runnable.items()), skipped, setup_error)
+    finally:
+        if teardown is not None:
+            try:
+                teardown()
+            except Exception as e:
+                sys.stderr.write("teardown failed\n")
+                report_exception(e)
+                teardown_ok = False
+    return teardown_ok
+
+def run_results(tests, results, skipped, setup_error):
+    results = iter(results)
+    cur = 0
+    for k in tests:
+        cur = cur + 1
+        if k in skipped:
+            sys.stderr.write("%s: setup failed: %s\n" % (k, setup_error))
+            sys.stderr.flush()
             ret = -1
+        else:
+            ret = next(results)
+        if ret == 0:
+            print("ok %d - %s" % (cur, k))
+        elif ret == 77:
+            print("ok %d - %s #SKIP" % (cur, k))
+        else:
             print("not ok %d - %s" % (cur, k))
+        sys.stdout.flush()
 
+# cached so that the forked workers share the directory created by the parent
+@functools.lru_cache(maxsize=1)
 def get_tests_root():
     return '%s/.testsuite-run-%d' % (os.getcwd(), os.getpid())
 
@@ -211,16 +305,15 @@ def run_and_get_output(config, detach=False, preserve_fds=None, pid_file=None,
         f.write("file")
 
     if id_container is None:
-        id_container = 'test-%s' % os.path.basename(temp_dir)
+        id_container = 'test-%s-%d' % (os.path.basename(temp_dir), os.getpid())
 
     config_path = os.path.join(temp_dir, relative_config_path)
     config_dir = os.path.dirname(config_path)
     if not os.path.exists(config_dir):
         os.makedirs(config_dir)
 
-    with open(config_path, "w") as config_file:
-        conf = json.dumps(config)
-        config_file.write(conf)
+    with open(config_path, "wb") as config_file:
+        config_file.write(json_dumps(config))
 
     init = os.getenv("INIT") or "tests/init"
     crun = get_crun_path()
@@ -266,20 +359,84 @@ def run_and_get_output(config, detach=False, preserve_fds=None, pid_file=None,
     else:
         return subprocess.check_output(args, cwd=temp_dir, stderr=stderr, env=env, close_fds=False).decode(), id_container
 
-def run_crun_command(args):
+# how long a single crun command may run before it is killed
+CRUN_COMMAND_TIMEOUT = 300
+
+def open_pidfd(proc):
+    # pidfd_open can be missing or, under seccomp profiles that do not
+    # know about it, fail with EPERM; the callers then fall back
+    try:
+        return os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+        return None
+
+def read_process_output(proc, timeout=None):
+    # this does the same as proc.communicate(timeout) and is not any
+    # faster; the pidfd only lets a single selector watch both the stdout
+    # pipe and the exit of proc, and the child is killed on timeout
+    pidfd = open_pidfd(proc)
+    if pidfd is None:
+        try:
+            out, _ = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            raise
+        return out
+    deadline = None if timeout is None else time.monotonic() + timeout
+    chunks = []
+    try:
+        with selectors.DefaultSelector() as sel:
+            sel.register(proc.stdout, selectors.EVENT_READ)
+            sel.register(pidfd, selectors.EVENT_READ)
+            pending = 2
+            while pending > 0:
+                remaining = None
+                if deadline is not None:
+                    remaining = max(deadline - time.monotonic(), 0)
+                events = sel.select(remaining)
+                if not events:
+                    proc.kill()
+                    proc.wait()
+                    raise subprocess.TimeoutExpired(proc.args, timeout, output=b"".join(chunks))
+                for key, _ in events:
+                    if key.fileobj is proc.stdout:
+                        data = os.read(proc.stdout.fileno(), 65536)
+                        if data:
+                            chunks.append(data)
+                            continue
+                    sel.unregister(key.fileobj)
+                    pending = pending - 1
+    finally:
+        os.close(pidfd)
+        proc.stdout.close()
+    proc.wait()
+    return b"".join(chunks)
+
+def run_crun_command(args, timeout=CRUN_COMMAND_TIMEOUT):
     cwd = os.getcwd()
     crun = get_crun_path()
     args = [crun] + args
-    return subprocess.check_output(args, close_fds=False).decode()
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, close_fds=False)
+    out = read_process_output(proc, timeout)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, args, output=out)
+    return out.decode()
 
-def tests_main(all_tests):
+# setup, if given, runs once before the tests listed in setup_tests (all
+# of them when it is None) and may return a teardown callable, which runs
+# before the tests root is removed
+def tests_main(all_tests, setup=None, setup_tests=None):
     os.environ["LANG"] = "C"
     tests_root = get_tests_root()
+    ok = False
     try:
         os.makedirs(tests_root)
-        run_all_tests(all_tests, os.getenv("RUN_TESTS"))
+        ok = run_all_tests(all_tests, os.getenv("RUN_TESTS"), setup, setup_tests)
     finally:
         shutil.rmtree(tests_root)
+    if not ok:
+        sys.exit(1)
 
 def is_rootless():
     if os.getuid() != 0: